@@ -1,129 +1,223 @@
 import argparse
-import copy
 import json
-import re
-from typing import List, Dict, Union
-from yaml import load, Loader
+import multiprocessing
+import os
+import sys
+from dataclasses import dataclass
+from typing import Iterable, List, Dict, Optional, Tuple, Union
+from yaml import load
 
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
 
-def parse_atom_definitions(adj_list: List[str]) -> List[Dict[str, Union[int, str, List, None]]]:
+try:
+    import orjson
+
+    def dumps_indented(value) -> bytes:
+        return orjson.dumps(value, option=orjson.OPT_INDENT_2)
+except ImportError:
+    def dumps_indented(value) -> bytes:
+        return json.dumps(value, indent=2, ensure_ascii=False).encode('utf-8')
+
+# Optional atom properties in the order they follow the element, keyed by their token prefix
+ATOM_PROPERTY_PREFIXES = (('unpaired', 'u'), ('pairs', 'p'), ('charge', 'c'), ('site', 's'), ('morphology', 'm'))
+
+
+@dataclass
+class AtomDefinition:
+    # Declared by hand rather than with dataclass(slots=True), which needs Python 3.10
+    __slots__ = ('number', 'label', 'element', 'unpaired', 'pairs', 'charge', 'site', 'morphology', 'bonds')
+    number: int
+    label: Optional[int]
+    element: str
+    unpaired: str
+    pairs: Optional[str]
+    charge: Optional[str]
+    site: Optional[str]
+    morphology: Optional[str]
+    bonds: List[Tuple[int, str]]
+
+
+def is_ascii_number(value: str) -> bool:
+    return value.isascii() and value.isdigit()
+
+
+def is_valid_atom_property(key: str, token: str) -> bool:
+    if key == 'unpaired' or key == 'pairs':
+        return is_ascii_number(token[1:])
+    if key == 'charge':
+        return is_ascii_number(token[2:] if token[1:2] in ('+', '-') else token[1:])
+    return True
+
+
+def parse_atom_definitions(adj_list: List[str]) -> List[AtomDefinition]:
     asterisk_label = 900
     result = []
     for line in adj_list:
         # https://reactionmechanismgenerator.github.io/RMG-Py/reference/molecule/adjlist.html#rmgpy-molecule-adjlist
-        pattern = r'^(\d+)(?:\s+(\*\d*))?\s+([A-Z][a-z]?)\s+(u\d+)(?:\s+(p\d+))?(?:\s+(c[-+]?\d+))?(s.*)?(m.*)?(?:\s+(\{\d+,\s*.*\}(?:\s+\{\d+,\s*.*\})*))?$'
-        match = re.match(pattern, line.strip())
-        if not match:
+        head, has_bonds, bond_definitions = line.partition('{')
+        tokens = head.split()
+        if len(tokens) < 3 or not is_ascii_number(tokens[0]):
             raise ValueError("Invalid atom definition: " + line)
-        groups = match.groups()
-        bonds = [tuple(x.strip() for x in bond.strip('{}').split(',')) for bond in re.split(r'}\s+\{', groups[8])] if \
-            groups[8] is not None else []
-        bonds = [(int(x[0]), x[1]) for x in bonds]
+        position = 1
         label = None
-        if groups[1] is not None:
-            if groups[1] == '*':
+        if tokens[position][0] == '*':
+            if tokens[position] == '*':
                 label = asterisk_label
                 asterisk_label += 1
+            elif is_ascii_number(tokens[position][1:]):
+                label = int(tokens[position][1:])
             else:
-                label = int(groups[1][1::])
-        result.append({
-            'number': int(groups[0]),
-            'label': label,
-            'element': groups[2],
-            'unpaired': groups[3],
-            'pairs': groups[4],
-            'charge': groups[5],
-            'site': groups[6],
-            'morphology': groups[7],
-            'bonds': bonds
-        })
+                raise ValueError("Invalid atom definition: " + line)
+            position += 1
+        element = tokens[position] if position < len(tokens) else ''
+        if not (element.isascii() and element.isalpha() and len(element) <= 2 and element[0].isupper() and
+                element[1:] == element[1:].lower()):
+            raise ValueError("Invalid atom definition: " + line)
+        position += 1
+        properties = []
+        for key, prefix in ATOM_PROPERTY_PREFIXES:
+            if position < len(tokens) and tokens[position][0] == prefix:
+                if not is_valid_atom_property(key, tokens[position]):
+                    raise ValueError("Invalid atom definition: " + line)
+                properties.append(sys.intern(tokens[position]))
+                position += 1
+            else:
+                properties.append(None)
+        if position != len(tokens) or properties[0] is None:
+            raise ValueError("Invalid atom definition: " + line)
+        bonds = []
+        if has_bonds:
+            for bond in bond_definitions.split('{'):
+                bond = bond.rstrip()
+                target, has_order, order = bond[:-1].partition(',')
+                target = target.strip()
+                if not bond.endswith('}') or not has_order or not is_ascii_number(target):
+                    raise ValueError("Invalid atom definition: " + line)
+                bonds.append((int(target), sys.intern(order.strip())))
+        result.append(AtomDefinition(int(tokens[0]), label, sys.intern(element), *properties, bonds))
     return result
 
 
-def atom_definition_to_string(atom) -> str:
-    data = [str(atom['number'])]
-    if atom['label'] is not None:
-        data.append('*' + str(atom['label']))
-    data.append(atom['element'])
-    data.append(atom['unpaired'])
-    if atom['pairs'] is not None:
-        data.append(atom['pairs'])
-    if atom['charge'] is not None:
-        data.append(atom['charge'])
-    if atom['site'] is not None:
-        data.append(atom['site'])
-    if atom['morphology'] is not None:
-        data.append(atom['morphology'])
-    for bond in atom['bonds']:
+def atom_definition_to_string(atom: AtomDefinition) -> str:
+    data = [str(atom.number)]
+    if atom.label is not None:
+        data.append('*' + str(atom.label))
+    data.append(atom.element)
+    data.append(atom.unpaired)
+    if atom.pairs is not None:
+        data.append(atom.pairs)
+    if atom.charge is not None:
+        data.append(atom.charge)
+    if atom.site is not None:
+        data.append(atom.site)
+    if atom.morphology is not None:
+        data.append(atom.morphology)
+    for bond in atom.bonds:
         data.append('{%s,%s}' % (bond[0], bond[1]))
     return ' '.join(data)
 
 
+def process_reaction(reaction: Dict) -> Optional[Dict[str, Union[int, str, List[str]]]]:
+    if 'reactant' not in reaction or 'product' not in reaction:
+        return None
+
+    reactants_graph = parse_atom_definitions([x for x in reaction['reactant'].split('\n') if x.strip() != ''])
+    products_graph = parse_atom_definitions([x for x in reaction['product'].split('\n') if x.strip() != ''])
+
+    reactant_id_index_map = {
+        atom.label: i
+        for i, atom in enumerate(reactants_graph)
+        if atom.label is not None
+    }
+    reactant_number_id_map = {
+        atom.number: atom.label
+        for atom in reactants_graph
+        if atom.label is not None
+    }
+    reactant_id_number_map = {value: key for key, value in reactant_number_id_map.items()}
+    product_id_index_map = {
+        atom.label: i
+        for i, atom in enumerate(products_graph)
+        if atom.label is not None
+    }
+    product_number_id_map = {
+        atom.number: atom.label
+        for atom in products_graph
+        if atom.label is not None
+    }
+    mapped_products_graph = [
+        AtomDefinition(atom.number, atom.label, atom.element, atom.unpaired, atom.pairs, atom.charge, atom.site,
+                       atom.morphology, atom.bonds)
+        for atom in reactants_graph
+    ]
+    for _id, index in reactant_id_index_map.items():
+        reactant_atom = mapped_products_graph[index]
+        product_atom = products_graph[product_id_index_map[_id]]
+        reactant_atom.unpaired = product_atom.unpaired
+        reactant_atom.pairs = product_atom.pairs
+        reactant_atom.charge = product_atom.charge
+        # TODO: site and morphology mapping?
+        bonds = [b for b in reactant_atom.bonds if b[0] not in reactant_number_id_map]
+        for bond in product_atom.bonds:
+            bond_target_id = product_number_id_map.get(bond[0])
+            if bond_target_id is not None:
+                bonds.append((reactant_id_number_map[bond_target_id], bond[1]))
+        reactant_atom.bonds = bonds
+    max_id = max(reactant_id_index_map.keys())
+    for i, atom in enumerate(mapped_products_graph):
+        if atom.label is None:
+            max_id += 1
+            reactants_graph[i].label = max_id
+            atom.label = max_id
+    return {
+        'index': reaction['index'],
+        'reaction': reaction['reaction'],
+        'reaction_family': reaction['reaction_family'],
+        'reactant': [atom_definition_to_string(x) for x in reactants_graph],
+        'product': [atom_definition_to_string(x) for x in mapped_products_graph]
+    }
+
+
+def write_output(path: str, entries: Iterable[Dict]):
+    # Entries are serialized one at a time, laid out as json.dump(output, f, indent=2) would. They are streamed into
+    # a temporary file next to the output, which only replaces the output once the array is complete.
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(b'[')
+            separator = b'\n  '
+            for entry in entries:
+                f.write(separator)
+                f.write(dumps_indented(entry).replace(b'\n', b'\n  '))
+                separator = b',\n  '
+            f.write(b']' if separator == b'\n  ' else b'\n]')
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
 def main():
     parser = argparse.ArgumentParser(description="Process a reaction adjacency list file and extract atom maps.")
     parser.add_argument('--input', required=True, help='Path to the input chemkin/reaction_adjacency_lists.txt')
     parser.add_argument('--output', default='atom-atom-maps.json', help='Path to the output atom-atom-maps.json')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of worker processes used to map the reactions, at least 1 (default: 1)')
     args = parser.parse_args()
-    output = []
+    if args.processes < 1:
+        parser.error('--processes must be at least 1')
     with open(args.input, 'r') as f:
         data = load(f, Loader=Loader)
-        for reaction in data['reactions']:
-            if 'reactant' in reaction and 'product' in reaction:
-                reactants_graph = parse_atom_definitions(
-                    [x for x in reaction['reactant'].split('\n') if x.strip() != ''])
-                products_graph = parse_atom_definitions([x for x in reaction['product'].split('\n') if x.strip() != ''])
-
-                reactant_id_index_map = {
-                    atom['label']: i
-                    for i, atom in enumerate(reactants_graph)
-                    if atom['label'] is not None
-                }
-                reactant_number_id_map = {
-                    atom['number']: atom['label']
-                    for atom in reactants_graph
-                    if atom['label'] is not None
-                }
-                product_id_index_map = {
-                    atom['label']: i
-                    for i, atom in enumerate(products_graph)
-                    if atom['label'] is not None
-                }
-                product_number_id_map = {
-                    atom['number']: atom['label']
-                    for atom in products_graph
-                    if atom['label'] is not None
-                }
-                mapped_products_graph = copy.deepcopy(reactants_graph)
-                for _id, index in reactant_id_index_map.items():
-                    reactant_atom = mapped_products_graph[index]
-                    product_atom = products_graph[product_id_index_map[_id]]
-                    reactant_atom['unpaired'] = product_atom['unpaired']
-                    reactant_atom['pairs'] = product_atom['pairs']
-                    reactant_atom['charge'] = product_atom['charge']
-                    # TODO: site and morphology mapping?
-                    bonds = [b for b in reactant_atom['bonds'] if b[0] not in reactant_number_id_map]
-                    for bond in product_atom['bonds']:
-                        if bond[0] in product_number_id_map:
-                            bond_target_id = product_number_id_map[bond[0]]
-                            bond_mapped_number = mapped_products_graph[reactant_id_index_map[bond_target_id]]['number']
-                            bonds.append((bond_mapped_number, bond[1]))
-                    reactant_atom['bonds'] = bonds
-                max_id = max(reactant_id_index_map.keys())
-                for i, atom in enumerate(mapped_products_graph):
-                    if atom['label'] is None:
-                        max_id += 1
-                        reactants_graph[i]['label'] = max_id
-                        atom['label'] = max_id
-                output.append({
-                    'index': reaction['index'],
-                    'reaction': reaction['reaction'],
-                    'reaction_family': reaction['reaction_family'],
-                    'reactant': [atom_definition_to_string(x) for x in reactants_graph],
-                    'product': [atom_definition_to_string(x) for x in mapped_products_graph]
-                })
-
-    with open(args.output, 'w', encoding='utf-8', newline='') as f:
-        json.dump(output, f, indent=2)
+    if args.processes > 1:
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.imap(process_reaction, data['reactions'], chunksize=16)
+            write_output(args.output, (x for x in results if x is not None))
+    else:
+        write_output(args.output, (x for x in map(process_reaction, data['reactions']) if x is not None))
 
 
 if __name__ == "__main__":